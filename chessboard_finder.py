@@ -12,9 +12,30 @@
 # optional arguments:
 #   -h, --help  show this help message and exit
 
+import time
+import threading
+from collections import OrderedDict
+
 import numpy as np
 import PIL.Image
 
+# Max number of board layouts kept in the geometry cache
+GEOMETRY_CACHE_SIZE = 256
+
+# A cached board position is only reused if the checkerboard correlation
+# of the new image is at least this fraction of the correlation measured
+# when the corners were first detected
+GEOMETRY_CACHE_MIN_SCORE_RATIO = 0.5
+
+def _checkerboard_kernel():
+    """ 64x64 pixel ideal chessboard with 8x8 pixel tiles, normalized
+    """
+    k = 8 # Arbitrarily chose 8x8 pixel tiles for correlation image
+    quad = np.ones([k,k])
+    kernel = np.vstack([np.hstack([quad,-quad]), np.hstack([-quad,quad])])
+    kernel = np.tile(kernel,(4,4)) # Becomes an 8x8 alternating grid (chessboard)
+    return kernel/np.linalg.norm(kernel) # normalize
+
 def _get_all_sequences(seq, min_seq_len=7, err_px=5):
     """ Given sequence of increasing numbers, get all sequences with common
         spacing (within err_px) that contain at least min_seq_len values
@@ -203,12 +224,8 @@ def detect_chessboard_corners(img_arr_gray, noise_threshold = 8000):
     gray_img_crop = PIL.Image.fromarray(img_arr_gray).crop(corners)
 
     # Build a kernel image of an idea chessboard to correlate against
-    k = 8 # Arbitrarily chose 8x8 pixel tiles for correlation image
-    quad = np.ones([k,k])
-    kernel = np.vstack([np.hstack([quad,-quad]), np.hstack([-quad,quad])])
-    kernel = np.tile(kernel,(4,4)) # Becomes an 8x8 alternating grid (chessboard)
-    kernel = kernel/np.linalg.norm(kernel) # normalize
     # 8*8 = 64x64 pixel ideal chessboard
+    kernel = _checkerboard_kernel()
 
     k = 0
     n = max(len(sub_seqs_x), len(sub_seqs_y))
@@ -225,7 +242,7 @@ def detect_chessboard_corners(img_arr_gray, noise_threshold = 8000):
             sub_corners = np.array([
                 sub_seqs_y[j][0]-corners[0]-dy, sub_seqs_x[i][0]-corners[1]-dx,
                 sub_seqs_y[j][-1]-corners[0]+dy, sub_seqs_x[i][-1]-corners[1]+dx
-            ], dtype=np.int)
+            ], dtype=int)
 
             # Generate crop candidate, nearest pixel is fine for correlation check
             sub_img = gray_img_crop.crop(sub_corners).resize((64,64)) 
@@ -240,13 +257,142 @@ def detect_chessboard_corners(img_arr_gray, noise_threshold = 8000):
                 ]
     return final_corners
 
-def get_chessboard_corners(img_arr, detect_corners=False):
+def _checkerboard_score(img_arr_gray, corners):
+    """ Normalized correlation (0 to 1) between the image cropped to the
+        corners and an ideal chessboard
+    """
+    sub_img = PIL.Image.fromarray(img_arr_gray).crop(corners).resize((64,64))
+    sub_img = np.asarray(sub_img, dtype=np.float64)
+    sub_img = sub_img - sub_img.mean()
+    norm = np.linalg.norm(sub_img)
+    if norm == 0:
+        return 0.0
+    # Use absolute since it's possible board is rotated 90 deg
+    return float(np.abs(np.sum(_checkerboard_kernel() * sub_img)) / norm)
+
+def _layout_fingerprint(img_arr_gray, n_bins=8, border_px=4):
+    """ Cheap fingerprint of where a chessboard is likely to be in an image:
+        the image size, plus the coarsely quantized brightness of the image
+        border (top, bottom, left, right), downsampled to n_bins per side
+    """
+    height, width = img_arr_gray.shape[:2]
+    strips = [
+        img_arr_gray[:border_px, :],
+        img_arr_gray[-border_px:, :],
+        img_arr_gray[:, :border_px].T,
+        img_arr_gray[:, -border_px:].T,
+    ]
+    signature = []
+    for strip in strips:
+        profile = strip.mean(axis=0)
+        signature.extend(int(b.mean()) >> 5 for b in np.array_split(profile, n_bins))
+    return (height, width, bytes(signature))
+
+class ChessboardGeometryCache:
+    """ Remembers validated chessboard corners by layout fingerprint, so
+        images from a source with a fixed board position (same site or app,
+        same image size) skip full corner detection. A cached hit is
+        verified with a single checkerboard correlation check, and full
+        detection runs again if it fails. Safe to share between threads
+    """
+
+    def __init__(self, max_size=GEOMETRY_CACHE_SIZE,
+                 min_score_ratio=GEOMETRY_CACHE_MIN_SCORE_RATIO):
+        self.max_size = max_size
+        self.min_score_ratio = min_score_ratio
+        self._entries = OrderedDict()
+        # Guards _entries and the counters. Checkerboard scores are computed
+        # without holding it
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.rejected = 0
+        self._detect_time = 0.0
+        self._n_detections = 0
+        self._verify_time = 0.0
+
+    def lookup(self, img_arr_gray):
+        """ Returns (fingerprint, corners) where corners is None unless a
+            cached board position passed verification
+        """
+        t0 = time.perf_counter()
+        fingerprint = _layout_fingerprint(img_arr_gray)
+        with self._lock:
+            entry = self._entries.get(fingerprint)
+        corners = None
+        if entry is not None:
+            (cached_corners, cached_score) = entry
+            score = _checkerboard_score(img_arr_gray, cached_corners)
+            if score >= self.min_score_ratio * cached_score:
+                corners = cached_corners
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+            elif corners is not None:
+                self.hits += 1
+                if fingerprint in self._entries:
+                    self._entries.move_to_end(fingerprint)
+            else:
+                self.rejected += 1
+                # Another thread may have removed or replaced the entry
+                if self._entries.get(fingerprint) is entry:
+                    del self._entries[fingerprint]
+            self._verify_time += time.perf_counter() - t0
+        return (fingerprint, corners)
+
+    def store(self, fingerprint, img_arr_gray, corners):
+        """ Caches corners that passed validation
+        """
+        score = _checkerboard_score(img_arr_gray, corners)
+        with self._lock:
+            self._entries[fingerprint] = (corners, score)
+            self._entries.move_to_end(fingerprint)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def record_detection_time(self, seconds):
+        with self._lock:
+            self._detect_time += seconds
+            self._n_detections += 1
+
+    def report(self):
+        """ Hit rate and estimated time saved, assuming each hit would have
+            taken the average full detection time
+        """
+        n_lookups = self.hits + self.misses + self.rejected
+        if n_lookups == 0:
+            return 'Chessboard geometry cache: no lookups'
+        avg_detect_time = self._detect_time / max(self._n_detections, 1)
+        time_saved = self.hits * avg_detect_time - self._verify_time
+        return (
+            'Chessboard geometry cache: {} hits, {} misses, {} rejected '
+            '({:.1%} hit rate), ~{:.3f}s saved'
+        ).format(
+            self.hits, self.misses, self.rejected,
+            self.hits / n_lookups, time_saved
+        )
+
+# Shared by all calls to get_chessboard_corners in this process
+geometry_cache = ChessboardGeometryCache()
+
+def get_chessboard_corners(img_arr, detect_corners=False, cache=geometry_cache):
     """ Returns a tuple of (corners, error_message)
+
+        cache = ChessboardGeometryCache to look up and store validated
+        corners in, or None to always run full corner detection
     """
     if not detect_corners:
         # Don't try to detect corners. Assume the entire image is a board
         return (([0, 0, img_arr.shape[0], img_arr.shape[1]]), None)
+    fingerprint = None
+    if cache is not None:
+        fingerprint, corners = cache.lookup(img_arr)
+        if corners is not None:
+            return (corners, None)
+    t0 = time.perf_counter()
     corners = detect_chessboard_corners(img_arr)
+    if cache is not None:
+        cache.record_detection_time(time.perf_counter() - t0)
     if corners is None:
         return (None, "Failed to find corners in chessboard image")
     width = corners[2] - corners[0]
@@ -257,5 +403,6 @@ def get_chessboard_corners(img_arr, detect_corners=False):
     if corners[0] > 1 or corners[1] > 1:
         # TODO generalize this for chessboards positioned within images
         return (corners, "Invalid corners - (x,y) are too far from (0,0)")
+    if cache is not None:
+        cache.store(fingerprint, img_arr, corners)
     return (corners, None)
-
@@ -1,41 +1,108 @@
+from io import BytesIO
+
 import numpy as np
 import PIL.Image
 
-def _get_resized_chessboard(chessboard_img_path):
-    """ chessboard_img_path = path to a chessboard image
+from chessboard_finder import get_chessboard_corners, geometry_cache
+
+def open_chessboard_image(chessboard_img):
+    """ chessboard_img = path to a chessboard image, or the image itself as
+        bytes, a file-like object, a numpy array or a PIL image
+    """
+    if isinstance(chessboard_img, PIL.Image.Image):
+        return chessboard_img
+    if isinstance(chessboard_img, np.ndarray):
+        return PIL.Image.fromarray(chessboard_img)
+    if isinstance(chessboard_img, (bytes, bytearray, memoryview)):
+        return PIL.Image.open(BytesIO(chessboard_img))
+    return PIL.Image.open(chessboard_img)
+
+def crop_to_chessboard(chessboard_img, cache=geometry_cache):
+    """ Crops a chessboard image to the detected corners of the chessboard
+        cache = ChessboardGeometryCache to look up and store corners in
+
+        Returns (img, error_message). img is the whole image if no valid
+        corners are found
+    """
+    img = open_chessboard_image(chessboard_img).convert('RGB')
+    img_arr_gray = np.asarray(img.convert('L'), dtype=np.uint8)
+    corners, error = get_chessboard_corners(img_arr_gray, detect_corners=True, cache=cache)
+    if error is not None:
+        return (img, error)
+    return (img.crop(corners), None)
+
+def _get_resized_chessboard(chessboard_img):
+    """ chessboard_img = path to a chessboard image, or image data
         Returns a 256x256 image of a chessboard (32x32 per tile)
     """
-    img_data = PIL.Image.open(chessboard_img_path).convert('RGB')
+    img_data = open_chessboard_image(chessboard_img).convert('RGB')
     return img_data.resize([256, 256], PIL.Image.BILINEAR)
 
-def get_chessboard_tiles(chessboard_img_path, use_grayscale=True):
-    """ chessboard_img_path = path to a chessboard image
+def get_chessboard_tiles_array(chessboard_img, use_grayscale=True, out=None):
+    """ chessboard_img = path to a chessboard image, or image data
         use_grayscale = true/false for whether to return tiles in grayscale
+        out = optional (64, 32, 32, n_channels) uint8 array to write tiles to
 
-        Returns a list (length 64) of 32x32 image data
+        Returns a (64, 32, 32, n_channels) uint8 array of tiles in order from
+        top-left to bottom-right (A8, B8, ..., G1, H1)
     """
-    img_data = _get_resized_chessboard(chessboard_img_path)
+    img_data = _get_resized_chessboard(chessboard_img)
     if use_grayscale:
         img_data = img_data.convert('L', (0.2989, 0.5870, 0.1140, 0))
     chessboard_256x256_img = np.asarray(img_data, dtype=np.uint8)
-    # 64 tiles in order from top-left to bottom-right (A8, B8, ..., G1, H1)
-    tiles = [None] * 64
-    for rank in range(8): # rows/ranks (numbers)
-        for file in range(8): # columns/files (letters)
-            sq_i = rank * 8 + file
-            tile = np.zeros([32, 32, 3], dtype=np.uint8)
-            for i in range(32):
-                for j in range(32):
-                    if use_grayscale:
-                        tile[i, j] = chessboard_256x256_img[
-                            rank*32 + i,
-                            file*32 + j,
-                        ]
-                    else:
-                        tile[i, j] = chessboard_256x256_img[
-                            rank*32 + i,
-                            file*32 + j,
-                            :,
-                        ]
-            tiles[sq_i] = PIL.Image.fromarray(tile, 'RGB')
-    return tiles
+    n_channels = 1 if use_grayscale else 3
+    # (rank, y, file, x, channel) => (rank, file, y, x, channel)
+    tiles = chessboard_256x256_img.reshape(8, 32, 8, 32, n_channels) \
+        .transpose(0, 2, 1, 3, 4)
+    if out is None:
+        return tiles.reshape(64, 32, 32, n_channels)
+    # Assigning to out itself, not a reshape of it, since reshaping an array
+    # that isn't contiguous returns a copy
+    assert out.shape == (64, 32, 32, n_channels) and out.dtype == np.uint8, \
+        'out must be a (64, 32, 32, {}) uint8 array'.format(n_channels)
+    out[...] = tiles.reshape(64, 32, 32, n_channels)
+    return out
+
+def get_chessboard_tiles(chessboard_img, use_grayscale=True):
+    """ chessboard_img = path to a chessboard image, or image data
+        use_grayscale = true/false for whether to return tiles in grayscale
+
+        Returns a list (length 64) of 32x32 image data
+    """
+    tiles = get_chessboard_tiles_array(chessboard_img, use_grayscale)
+    if use_grayscale:
+        # Grayscale tiles are saved as RGB images with identical channels
+        tiles = np.repeat(tiles, 3, axis=3)
+    return [PIL.Image.fromarray(tile, 'RGB') for tile in tiles]
+
+# Version prefix of tile_phash values. Tiles hashed with an older version
+# are hashed again by generate_tiles.py
+PHASH_VERSION = '2'
+
+# How much lighter or darker (0-255) than the tile's mean brightness a cell
+# has to be to set a hash bit, so pixel noise in flat areas doesn't flip bits
+PHASH_MARGIN = 16
+
+def tile_phash(tile_img, hash_size=16):
+    """ tile_img = PIL image of a tile
+
+        Returns a perceptual hash hex string. Identical and near-identical
+        tiles have hashes within a small Hamming distance of each other.
+        Combines which cells of a hash_size x hash_size thumbnail are clearly
+        lighter or darker than the tile (shape) with a thermometer code of a
+        coarse 4x4 thumbnail (brightness), so that e.g. empty light and empty
+        dark squares are far apart
+    """
+    gray_img = tile_img.convert('L')
+    cells = np.asarray(
+        gray_img.resize([hash_size, hash_size], PIL.Image.BOX), dtype=np.int16
+    )
+    mean = cells.mean()
+    lighter = cells > mean + PHASH_MARGIN
+    darker = cells < mean - PHASH_MARGIN
+    # Brightness level k (0-7) is encoded as k set bits out of 7, so the
+    # Hamming distance grows with the difference in brightness
+    levels = np.asarray(gray_img.resize([4, 4], PIL.Image.BOX), dtype=np.uint8) >> 5
+    brightness = levels.reshape(-1, 1) > np.arange(7)
+    bits = np.concatenate([lighter.ravel(), darker.ravel(), brightness.ravel()])
+    return '{}:{}'.format(PHASH_VERSION, np.packbits(bits).tobytes().hex())
@@ -5,6 +5,7 @@ FEN_CHARS = '1RNBQKPrnbqkp'
 CHESSBOARDS_DIR = './images/chessboards'
 
 # Try to detect the corners of a chessboard in the image
+# Detected corners are cached by image layout, see chessboard_finder.py
 DETECT_CORNERS = False
 
 # Base directory for 32x32 PNG chessboard squares for
@@ -16,3 +17,11 @@ USE_GRAYSCALE = True
 
 # Where neural network model/weights are stored
 NN_MODEL_PATH = './nn/model.tf'
+
+# SQLite manifest of chessboard images and generated tiles, used to
+# incrementally generate tiles and to build training datasets
+MANIFEST_PATH = './images/manifest.db'
+
+# Number of tiles per call to the serving signature exported with the
+# neural network model (one chessboard)
+NN_SERVING_BATCH_SIZE = 64
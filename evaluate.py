@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+
+# Evaluates the neural network model on labeled chessboard images, using the
+# filename of each image in CHESSBOARDS_DIR as its label.
+# Reports tile and board accuracy, a confusion matrix of FEN chars and
+# accuracy per source set (sub-directory of CHESSBOARDS_DIR)
+
+import os
+import time
+import queue
+import argparse
+from glob import glob
+from multiprocessing import cpu_count
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+
+import tensorflow as tf
+from tensorflow.keras import models
+import numpy as np
+
+from constants import (
+    CHESSBOARDS_DIR, NN_MODEL_PATH, FEN_CHARS, USE_GRAYSCALE, DETECT_CORNERS
+)
+from tile_ring_buffer import TileRingBuffer, start_decoders
+
+BOARDS_PER_BATCH = 64
+
+# How often to check that decoder processes are still alive while waiting
+# for decoded chessboards
+DECODER_POLL_SECONDS = 1
+
+# Maps the byte value of a FEN char to its index in FEN_CHARS
+_FEN_CHAR_INDEXES = np.full(256, -1, dtype=np.int8)
+_FEN_CHAR_INDEXES[np.frombuffer(FEN_CHARS.encode(), dtype=np.uint8)] = np.arange(len(FEN_CHARS))
+
+def _board_labels(chessboard_img_path):
+    """ Returns a size-64 array of FEN_CHARS indexes from the image filename,
+        or None if the filename isn't a valid label
+    """
+    label = os.path.basename(chessboard_img_path)[:-4].replace('-', '')
+    if len(label) != 64:
+        return None
+    labels = _FEN_CHAR_INDEXES[np.frombuffer(label.encode(), dtype=np.uint8)]
+    if (labels < 0).any():
+        return None
+    return labels
+
+def _model_input_fn(model):
+    """ Returns a function that converts uint8 tiles to the model's input.
+        Models trained before tiles were kept as uint8, such as the v0.5
+        pre-trained model, take float32 tiles with values in [0, 1]
+    """
+    if tf.as_dtype(model.inputs[0].dtype) == tf.uint8:
+        return lambda tiles: tiles
+    return lambda tiles: tiles.astype(np.float32) / 255
+
+def evaluate_chessboards(model, ring, n_boards, decoders,
+                         boards_per_batch=BOARDS_PER_BATCH):
+    """ Predicts all tiles of n_boards chessboards published to the ring
+        buffer by the decoders processes, in batches of boards_per_batch
+        boards.
+
+        Slots are handed out in order, so each run of boards_per_batch
+        consecutive slots is passed to the model in place, as a view of the
+        shared memory. Only the last partial batch is copied, or every batch
+        for models that take float32 tiles. The ring buffer must have a
+        multiple of boards_per_batch slots.
+
+        A decoder process that dies (e.g. killed for running out of memory)
+        never publishes the slot it was writing to, so runs of consecutive
+        slots may never fill. Once one dies, published slots are copied and
+        predicted in batches of any slots instead, and its boards are
+        reported as not decoded.
+
+        Returns a (n_boards, 64) array of predicted FEN_CHARS indexes, and a
+        size-n_boards boolean array of which boards were decoded
+    """
+    n_slots, n_channels = ring.shape[0], ring.shape[-1]
+    assert n_slots % boards_per_batch == 0
+    predictions = np.zeros([n_boards, 64], dtype=np.int8)
+    decoded = np.zeros(n_boards, dtype=bool)
+    # Published slots => board index, or None if the board failed to decode
+    ready = {}
+    model_input = _model_input_fn(model)
+
+    def predict_slots(slots, tiles):
+        board_indexes = [ready.pop(slot) for slot in slots]
+        probabilities = model.predict_on_batch(
+            model_input(tiles.reshape(-1, 32, 32, n_channels))
+        )
+        slot_predictions = np.argmax(probabilities, axis=1).reshape(len(slots), 64)
+        for n, i in enumerate(board_indexes):
+            if i is not None:
+                predictions[i] = slot_predictions[n]
+                decoded[i] = True
+        for slot in slots:
+            ring.release(slot)
+        print('\r{}/{} boards'.format(decoded.sum(), n_boards), end='', flush=True)
+
+    def predict_ready_slots(min_slots=1):
+        while len(ready) >= min_slots:
+            slots = sorted(ready)[:boards_per_batch]
+            predict_slots(slots, ring.blocks[slots])
+
+    running_decoders = {decoder.pid: decoder for decoder in decoders}
+    in_place = True
+    next_slot = 0
+    while running_decoders:
+        try:
+            slot, i, tiles = ring.get(timeout=DECODER_POLL_SECONDS)
+        except queue.Empty:
+            for pid, decoder in list(running_decoders.items()):
+                if not decoder.is_alive():
+                    print('\nDecoder process {} exited with code {} before it was done'.format(
+                        pid, decoder.exitcode
+                    ))
+                    del running_decoders[pid]
+                    in_place = False
+            if not in_place:
+                predict_ready_slots()
+            continue
+        if slot is None:
+            # i is the pid of a decoder process that's done
+            running_decoders.pop(i, None)
+            continue
+        ready[slot] = i if tiles is not None else None
+        if not in_place:
+            predict_ready_slots(boards_per_batch)
+            continue
+        while all(s in ready for s in range(next_slot, next_slot + boards_per_batch)):
+            batch_slots = list(range(next_slot, next_slot + boards_per_batch))
+            predict_slots(batch_slots, ring.blocks[next_slot:next_slot + boards_per_batch])
+            next_slot = (next_slot + boards_per_batch) % n_slots
+    predict_ready_slots()
+    print()
+    return (predictions, decoded)
+
+def confusion_matrix(labels, predictions):
+    """ (n_classes, n_classes) matrix of tile counts, where rows are the
+        actual FEN chars and columns are the predicted FEN chars
+    """
+    n_classes = len(FEN_CHARS)
+    return np.bincount(
+        labels.ravel().astype(np.int64) * n_classes + predictions.ravel(),
+        minlength=n_classes * n_classes,
+    ).reshape(n_classes, n_classes)
+
+def _print_report(labels, predictions, sources, elapsed):
+    n_boards = len(labels)
+    correct_tiles = labels == predictions
+    correct_boards = correct_tiles.all(axis=1)
+    print('Evaluated {} boards ({} tiles) in {:.1f}s - {:.1f} boards/s'.format(
+        n_boards, labels.size, elapsed, n_boards / elapsed
+    ))
+    print('Tile accuracy:  {:.5f}'.format(correct_tiles.mean()))
+    print('Board accuracy: {:.5f}'.format(correct_boards.mean()))
+
+    print('\nConfusion matrix (rows = actual, columns = predicted):')
+    matrix = confusion_matrix(labels, predictions)
+    print('  ' + ''.join('{:>8}'.format(c) for c in FEN_CHARS))
+    for i, c in enumerate(FEN_CHARS):
+        print('{} '.format(c) + ''.join('{:>8}'.format(n) for n in matrix[i]))
+
+    print('\n{:<24} {:>8} {:>10} {:>10}'.format(
+        'source', 'boards', 'tile acc', 'board acc'
+    ))
+    source_names, source_indexes = np.unique(sources, return_inverse=True)
+    source_boards = np.bincount(source_indexes)
+    source_tile_acc = np.bincount(
+        source_indexes, weights=correct_tiles.mean(axis=1)
+    ) / source_boards
+    source_board_acc = np.bincount(
+        source_indexes, weights=correct_boards
+    ) / source_boards
+    for i, source in enumerate(source_names):
+        print('{:<24} {:>8} {:>10.5f} {:>10.5f}'.format(
+            source, source_boards[i], source_tile_acc[i], source_board_acc[i]
+        ))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("image_path", nargs="?",
+                        help="Path/glob to labeled PNG chessboard image(s)",
+                        default="{}/*/*.png".format(CHESSBOARDS_DIR))
+    parser.add_argument("-b", "--batch-size", help="Boards per inference batch",
+                        type=int, default=BOARDS_PER_BATCH)
+    parser.add_argument("-w", "--workers", help="Number of image decoding processes",
+                        type=int, default=cpu_count())
+    args = parser.parse_args()
+    print('Tensorflow {}'.format(tf.version.VERSION))
+
+    chessboard_img_paths = []
+    all_labels = []
+    for chessboard_img_path in sorted(glob(args.image_path)):
+        labels = _board_labels(chessboard_img_path)
+        if labels is None:
+            print('Skipping unlabeled chessboard image {}'.format(chessboard_img_path))
+            continue
+        chessboard_img_paths.append(chessboard_img_path)
+        all_labels.append(labels)
+    if not chessboard_img_paths:
+        print("No labeled chessboard images found!")
+        exit(1)
+    all_labels = np.stack(all_labels)
+    sources = np.array([
+        os.path.basename(os.path.dirname(p)) for p in chessboard_img_paths
+    ])
+
+    # Start decoding processes before Tensorflow loads the model
+    ring = TileRingBuffer(
+        n_slots=2 * args.batch_size, n_channels=1 if USE_GRAYSCALE else 3
+    )
+    decoders = start_decoders(
+        ring, chessboard_img_paths, args.workers,
+        use_grayscale=USE_GRAYSCALE, detect_corners=DETECT_CORNERS,
+    )
+    model = models.load_model(NN_MODEL_PATH)
+    t0 = time.perf_counter()
+    predictions, decoded = evaluate_chessboards(
+        model, ring, len(chessboard_img_paths), decoders, args.batch_size
+    )
+    elapsed = time.perf_counter() - t0
+    for decoder in decoders:
+        decoder.join()
+    ring.unlink()
+    if not decoded.all():
+        print('{} boards failed to decode and are left out of the report'.format(
+            (~decoded).sum()
+        ))
+    _print_report(all_labels[decoded], predictions[decoded], sources[decoded], elapsed)
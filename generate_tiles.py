@@ -4,6 +4,7 @@
 # Used for building training datasets
 
 import os
+import shutil
 from glob import glob
 import argparse
 import math
@@ -12,21 +13,34 @@ import numpy as np
 import PIL.Image
 
 from constants import CHESSBOARDS_DIR, TILES_DIR, USE_GRAYSCALE
-from chessboard_image import get_chessboard_tiles
+from chessboard_image import get_chessboard_tiles, tile_phash, PHASH_VERSION
+from manifest import (
+    open_manifest, get_board, board_content_hash, record_board, get_missing_boards,
+    remove_boards,
+    get_tiles_without_phash, set_tile_phashes,
+)
 
 OVERWRITE = False
 
+# Settings that change the generated tiles. Boards tiled with different
+# settings are tiled again
+TILE_SETTINGS = 'grayscale' if USE_GRAYSCALE else 'rgb'
+
 def _img_filename_prefix(chessboard_img_path):
     """ part of the image filename that shows which piece is on which square:
         RRqpBnNr-QKPkrQPK-PpbQnNB1-nRRBpNpk-Nqprrpqp-kKKbNBPP-kQnrpkrn-BKRqbbBp
     """
     return chessboard_img_path.split("/")[4][:-4]
 
+def _img_source(chessboard_img_path):
+    """ The source set (sub-directory of CHESSBOARDS_DIR) of a chessboard image
+    """
+    return chessboard_img_path.split("/")[3]
+
 def _img_sub_dir(chessboard_img_path):
     """ The sub-directory where the chessboard tile images will be saved
     """
-    sub_dir = chessboard_img_path.split("/")[3]
-    return os.path.join(TILES_DIR, sub_dir)
+    return os.path.join(TILES_DIR, _img_source(chessboard_img_path))
 
 def _img_save_dir(chessboard_img_path):
     """ The directory within the sub-directory that will contain the
@@ -43,6 +57,8 @@ def save_tiles(tiles, chessboard_img_path):
         a1_R.png (white rook on a1)
         d8_q.png (black queen on d8)
         c4_1.png (nothing on c4)
+
+        Returns a list of (tile_path, square_id, fen_char, phash) for the saved tiles
     """
     sub_dir = _img_sub_dir(chessboard_img_path)
     if not os.path.exists(sub_dir):
@@ -53,43 +69,113 @@ def save_tiles(tiles, chessboard_img_path):
         os.makedirs(img_save_dir)
     piece_positions = _img_filename_prefix(chessboard_img_path).split('-')
     files = 'abcdefgh'
+    saved_tiles = []
     for i in range(64):
         piece = piece_positions[math.floor(i / 8)][i % 8]
         sqr_id = '{}{}'.format(files[i % 8], 8 - math.floor(i / 8))
         tile_img_filename = '{}/{}_{}.png'.format(img_save_dir, sqr_id, piece)
         tiles[i].save(tile_img_filename, format='PNG')
+        saved_tiles.append((tile_img_filename, sqr_id, piece, tile_phash(tiles[i])))
+    return saved_tiles
 
-def generate_tiles_from_all_chessboards():
+def generate_tiles_from_all_chessboards(prune=False):
     """ Generates 32x32 PNGs for each square of all chessboards
         in CHESSBOARDS_DIR
+
+        Only new or changed chessboard images, or boards whose tiles are
+        missing or were generated with other settings, are tiled. Boards and
+        their tiles are recorded in the manifest at MANIFEST_PATH
+
+        Tiles of renamed (relabeled) chessboard images are deleted. Tiles of
+        chessboard images that are gone are kept for training, unless prune
+        is set
     """
     if not os.path.exists(TILES_DIR):
         os.makedirs(TILES_DIR)
-    chessboard_img_filenames = glob("{}/*/*.png".format(CHESSBOARDS_DIR))
+    chessboard_img_filenames = sorted(glob("{}/*/*.png".format(CHESSBOARDS_DIR)))
     num_chessboards = len(chessboard_img_filenames)
     num_success = 0
     num_skipped = 0
     num_failed = 0
+    conn = open_manifest()
     for i, chessboard_img_path in enumerate(chessboard_img_filenames):
-        print("%3d/%d %s" % (i + 1, num_chessboards, chessboard_img_path))
+        stat = os.stat(chessboard_img_path)
+        content_hash, changed = board_content_hash(conn, chessboard_img_path, stat)
         img_save_dir = _img_save_dir(chessboard_img_path)
-        if os.path.exists(img_save_dir) and not OVERWRITE:
-            print("\tIgnoring existing {}\n".format(img_save_dir))
+        if not changed and not OVERWRITE and os.path.exists(img_save_dir) and \
+                get_board(conn, chessboard_img_path)['tile_settings'] == TILE_SETTINGS:
             num_skipped += 1
             continue
+        print("%3d/%d %s" % (i + 1, num_chessboards, chessboard_img_path))
         tiles = get_chessboard_tiles(chessboard_img_path, use_grayscale=USE_GRAYSCALE)
         if len(tiles) != 64:
             print("\t!! Expected 64 tiles. Got {}\n".format(len(tiles)))
             num_failed += 1
             continue
-        save_tiles(tiles, chessboard_img_path)
+        saved_tiles = save_tiles(tiles, chessboard_img_path)
+        record_board(
+            conn, chessboard_img_path,
+            source=_img_source(chessboard_img_path),
+            label=_img_filename_prefix(chessboard_img_path),
+            content_hash=content_hash,
+            stat=stat,
+            tile_dir=img_save_dir,
+            tiles=saved_tiles,
+            tile_settings=TILE_SETTINGS,
+        )
         num_success += 1
+        if num_success % 100 == 0:
+            conn.commit()
+    removed_tile_dirs = []
+    num_orphaned = 0
+    if not chessboard_img_filenames:
+        print("No chessboard images found in {}. Keeping all tiles".format(CHESSBOARDS_DIR))
+    else:
+        # Tiles of renamed chessboard images are generated again under the
+        # new name, so the old tiles are always removed
+        renamed, orphaned = get_missing_boards(conn, chessboard_img_filenames)
+        if prune:
+            renamed += orphaned
+        else:
+            num_orphaned = len(orphaned)
+        removed_tile_dirs = remove_boards(conn, renamed)
+    conn.commit()
+    for tile_dir in removed_tile_dirs:
+        print("\tRemoving {}".format(tile_dir))
+        shutil.rmtree(tile_dir, ignore_errors=True)
+    num_removed = len(removed_tile_dirs)
+    num_hashed = backfill_tile_phashes(conn)
+    conn.close()
     print(
-        'Processed {} chessboard images ({} generated, {} skipped, {} failed)'.format(
-            num_chessboards, num_success, num_skipped, num_failed
+        'Processed {} chessboard images ({} generated, {} skipped, {} failed, {} removed)'.format(
+            num_chessboards, num_success, num_skipped, num_failed, num_removed
         )
     )
+    if num_orphaned:
+        print('Kept tiles of {} chessboard images that are no longer in {} '
+              '(run with --prune to delete them)'.format(num_orphaned, CHESSBOARDS_DIR))
+    if num_hashed:
+        print('Computed perceptual hashes for {} existing tiles'.format(num_hashed))
+
+def backfill_tile_phashes(conn):
+    """ Computes perceptual hashes for tiles in the manifest that were
+        generated before tiles were deduplicated, or hashed with an older
+        version of tile_phash. Returns the number of tiles that were hashed
+    """
+    tile_paths = get_tiles_without_phash(conn, PHASH_VERSION)
+    for i in range(0, len(tile_paths), 1000):
+        set_tile_phashes(conn, [
+            (tile_path, tile_phash(PIL.Image.open(tile_path)))
+            for tile_path in tile_paths[i:i + 1000]
+        ])
+        conn.commit()
+    return len(tile_paths)
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--prune", action="store_true",
+                        help="Delete tiles of chessboard images that are no longer in {}".format(
+                            CHESSBOARDS_DIR))
+    args = parser.parse_args()
     np.set_printoptions(suppress=True, precision=2)
-    generate_tiles_from_all_chessboards()
+    generate_tiles_from_all_chessboards(prune=args.prune)
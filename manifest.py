@@ -0,0 +1,265 @@
+import os
+import hashlib
+import sqlite3
+
+import numpy as np
+
+from constants import MANIFEST_PATH
+
+# Tiles with the same label whose perceptual hashes differ by at most this
+# many bits are grouped as near-duplicates
+PHASH_MAX_DISTANCE = 8
+
+# Hashes are split into this many bands to find candidate near-duplicates.
+# Must be greater than PHASH_MAX_DISTANCE, so near-duplicates always have at
+# least one identical band
+PHASH_N_BANDS = 16
+
+# boards: one row per chessboard image in CHESSBOARDS_DIR
+# tiles: one row per 32x32 tile PNG generated from a chessboard image, with
+#        a perceptual hash (phash) used to group duplicate tiles
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS boards (
+    path TEXT PRIMARY KEY,
+    source TEXT NOT NULL,
+    label TEXT NOT NULL,
+    content_hash TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    tile_dir TEXT NOT NULL,
+    tile_settings TEXT
+);
+CREATE TABLE IF NOT EXISTS tiles (
+    path TEXT PRIMARY KEY,
+    board_path TEXT NOT NULL REFERENCES boards(path) ON DELETE CASCADE,
+    source TEXT NOT NULL,
+    square TEXT NOT NULL,
+    fen_char TEXT NOT NULL,
+    phash TEXT
+);
+CREATE INDEX IF NOT EXISTS tiles_board_path ON tiles(board_path);
+"""
+
+def open_manifest(manifest_path=MANIFEST_PATH) -> sqlite3.Connection:
+    """ Opens (and creates if needed) the SQLite manifest of chessboard
+        images and the tiles generated from them
+    """
+    manifest_dir = os.path.dirname(manifest_path)
+    if manifest_dir and not os.path.exists(manifest_dir):
+        os.makedirs(manifest_dir)
+    conn = sqlite3.connect(manifest_path)
+    conn.execute('PRAGMA foreign_keys = ON')
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.executescript(SCHEMA)
+    tile_columns = [row[1] for row in conn.execute('PRAGMA table_info(tiles)')]
+    if 'phash' not in tile_columns:
+        # Manifests created before tiles were deduplicated
+        conn.execute('ALTER TABLE tiles ADD COLUMN phash TEXT')
+    board_columns = [row[1] for row in conn.execute('PRAGMA table_info(boards)')]
+    if 'tile_settings' not in board_columns:
+        # Manifests created before tiling settings were recorded
+        conn.execute('ALTER TABLE boards ADD COLUMN tile_settings TEXT')
+    conn.execute('CREATE INDEX IF NOT EXISTS tiles_phash ON tiles(phash, fen_char)')
+    return conn
+
+def file_content_hash(file_path):
+    """ sha1 hex digest of a file's contents
+    """
+    h = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def get_board(conn, board_path):
+    """ Returns the manifest row of a chessboard image as a dict,
+        or None if the image hasn't been recorded yet
+    """
+    row = conn.execute(
+        'SELECT path, source, label, content_hash, size, mtime, tile_dir, tile_settings '
+        'FROM boards WHERE path = ?', (board_path,)
+    ).fetchone()
+    if row is None:
+        return None
+    keys = ('path', 'source', 'label', 'content_hash', 'size', 'mtime', 'tile_dir',
+            'tile_settings')
+    return dict(zip(keys, row))
+
+def board_content_hash(conn, board_path, stat=None):
+    """ Returns (content_hash, changed) for a chessboard image. The file is
+        only re-hashed if its size or mtime differ from the manifest
+    """
+    stat = stat or os.stat(board_path)
+    board = get_board(conn, board_path)
+    if board is not None and board['size'] == stat.st_size \
+            and board['mtime'] == stat.st_mtime:
+        return (board['content_hash'], False)
+    content_hash = file_content_hash(board_path)
+    changed = board is None or board['content_hash'] != content_hash
+    if not changed:
+        # Same contents, the file was only touched
+        conn.execute(
+            'UPDATE boards SET size = ?, mtime = ? WHERE path = ?',
+            (stat.st_size, stat.st_mtime, board_path)
+        )
+    return (content_hash, changed)
+
+def record_board(conn, board_path, source, label, content_hash, stat,
+                 tile_dir, tiles, tile_settings=None):
+    """ Records a chessboard image and its tiles, replacing any previous
+        entries for the same image
+
+        tiles = list of (tile_path, square_id, fen_char, phash)
+        tile_settings = settings the tiles were generated with, so they can be
+                        regenerated when the settings change
+    """
+    conn.execute('DELETE FROM boards WHERE path = ?', (board_path,))
+    conn.execute(
+        'INSERT INTO boards (path, source, label, content_hash, size, mtime, tile_dir, tile_settings) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+        (board_path, source, label, content_hash, stat.st_size, stat.st_mtime, tile_dir,
+         tile_settings)
+    )
+    conn.executemany(
+        'INSERT OR REPLACE INTO tiles (path, board_path, source, square, fen_char, phash) '
+        'VALUES (?, ?, ?, ?, ?, ?)',
+        [(tile_path, board_path, source, square_id, fen_char, phash)
+         for (tile_path, square_id, fen_char, phash) in tiles]
+    )
+
+def get_missing_boards(conn, board_paths):
+    """ Returns (renamed, orphaned) lists of recorded boards whose images are
+        no longer in board_paths
+
+        renamed = the same image contents are now at another path in
+                  board_paths, e.g. the image was renamed (relabeled) or moved
+                  to another source
+        orphaned = the image is gone
+    """
+    conn.execute('CREATE TEMP TABLE IF NOT EXISTS current_boards (path TEXT PRIMARY KEY)')
+    conn.execute('DELETE FROM current_boards')
+    conn.executemany(
+        'INSERT OR IGNORE INTO current_boards (path) VALUES (?)',
+        [(p,) for p in board_paths]
+    )
+    renamed = []
+    orphaned = []
+    for (board_path, is_renamed) in conn.execute(
+        'SELECT path, content_hash IN ('
+        '    SELECT content_hash FROM boards WHERE path IN (SELECT path FROM current_boards)'
+        ') FROM boards WHERE path NOT IN (SELECT path FROM current_boards) ORDER BY path'
+    ):
+        (renamed if is_renamed else orphaned).append(board_path)
+    return (renamed, orphaned)
+
+def remove_boards(conn, board_paths):
+    """ Removes boards and their tiles from the manifest. Returns the tile
+        directories of the removed boards that no remaining board uses
+    """
+    conn.execute('CREATE TEMP TABLE IF NOT EXISTS removed_boards (path TEXT PRIMARY KEY)')
+    conn.execute('DELETE FROM removed_boards')
+    conn.executemany(
+        'INSERT OR IGNORE INTO removed_boards (path) VALUES (?)',
+        [(p,) for p in board_paths]
+    )
+    removed_tile_dirs = [row[0] for row in conn.execute(
+        'SELECT DISTINCT tile_dir FROM boards '
+        'WHERE path IN (SELECT path FROM removed_boards) '
+        'AND tile_dir NOT IN ('
+        '    SELECT tile_dir FROM boards WHERE path NOT IN (SELECT path FROM removed_boards)'
+        ') ORDER BY tile_dir'
+    )]
+    conn.execute('DELETE FROM boards WHERE path IN (SELECT path FROM removed_boards)')
+    return removed_tile_dirs
+
+def get_tiles_without_phash(conn, phash_version):
+    """ Returns paths of tiles that don't have a perceptual hash yet, or
+        were hashed with a different version of the hash
+    """
+    return [row[0] for row in conn.execute(
+        'SELECT path FROM tiles WHERE phash IS NULL OR phash NOT LIKE ? ORDER BY path',
+        (phash_version + ':%',)
+    )]
+
+def set_tile_phashes(conn, tile_phashes):
+    """ tile_phashes = list of (tile_path, phash)
+    """
+    conn.executemany(
+        'UPDATE tiles SET phash = ? WHERE path = ?',
+        [(phash, tile_path) for (tile_path, phash) in tile_phashes]
+    )
+
+def _phash_bits(phash):
+    return np.unpackbits(np.frombuffer(bytes.fromhex(phash.split(':')[-1]), dtype=np.uint8))
+
+def _group_near_duplicates(phashes, max_distance=PHASH_MAX_DISTANCE,
+                           n_bands=PHASH_N_BANDS):
+    """ Greedily groups distinct perceptual hashes that are within
+        max_distance bits of a group's first hash. Only groups sharing an
+        identical band with a hash are compared against it.
+
+        Returns a list with the group number of each hash
+    """
+    if not phashes:
+        return []
+    bits = np.stack([_phash_bits(phash) for phash in phashes])
+    band_edges = np.linspace(0, bits.shape[1], n_bands + 1).astype(int)
+    band_buckets = [{} for _ in range(n_bands)]
+    leader_bits = []
+    groups = []
+    for hash_bits in bits:
+        band_keys = [
+            hash_bits[band_edges[b]:band_edges[b + 1]].tobytes()
+            for b in range(n_bands)
+        ]
+        candidates = set()
+        for b, key in enumerate(band_keys):
+            candidates.update(band_buckets[b].get(key, ()))
+        group = None
+        if candidates:
+            candidates = sorted(candidates)
+            distances = (np.stack([leader_bits[c] for c in candidates]) != hash_bits).sum(axis=1)
+            if distances.min() <= max_distance:
+                group = candidates[int(distances.argmin())]
+        if group is None:
+            group = len(leader_bits)
+            leader_bits.append(hash_bits)
+            for b, key in enumerate(band_keys):
+                band_buckets[b].setdefault(key, []).append(group)
+        groups.append(group)
+    return groups
+
+def get_unique_tiles(conn, phash_version):
+    """ Groups identical and near-identical tiles with the same label by
+        the Hamming distance between their perceptual hashes. Returns a list
+        of (tile_path, fen_char, count) with one representative tile per
+        group, sorted by tile path. Tiles without a perceptual hash of
+        phash_version are returned on their own with a count of 1
+    """
+    # Tiles with identical hashes first, e.g. all empty squares of a theme
+    exact_groups = {}
+    unique_tiles = []
+    for (tile_path, fen_char, phash) in conn.execute(
+        'SELECT path, fen_char, phash FROM tiles ORDER BY path'
+    ):
+        if phash is None or not phash.startswith(phash_version + ':'):
+            unique_tiles.append((tile_path, fen_char, 1))
+            continue
+        group = exact_groups.setdefault((fen_char, phash), [tile_path, 0])
+        group[1] += 1
+
+    # Then near-identical hashes, separately for each label
+    phashes_by_fen_char = {}
+    for (fen_char, phash) in exact_groups:
+        phashes_by_fen_char.setdefault(fen_char, []).append(phash)
+    for fen_char, phashes in phashes_by_fen_char.items():
+        near_groups = {}
+        for phash, group in zip(phashes, _group_near_duplicates(phashes)):
+            tile_path, count = exact_groups[(fen_char, phash)]
+            near_group = near_groups.setdefault(group, [tile_path, 0])
+            near_group[0] = min(near_group[0], tile_path)
+            near_group[1] += count
+        unique_tiles.extend(
+            (tile_path, fen_char, count) for (tile_path, count) in near_groups.values()
+        )
+    return sorted(unique_tiles)
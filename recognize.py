@@ -1,41 +1,59 @@
 #!/usr/bin/env python3
 
+import time
+_start_time = time.perf_counter()
+
 import sys
+import argparse
 from glob import glob
-from io import BytesIO
 from functools import reduce
 import os
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 
-import tensorflow as tf
-from tensorflow.keras import models
 import numpy as np
 
 from constants import (
-    TILES_DIR, NN_MODEL_PATH, FEN_CHARS, USE_GRAYSCALE, DETECT_CORNERS
+    NN_MODEL_PATH, NN_SERVING_BATCH_SIZE, FEN_CHARS, USE_GRAYSCALE, DETECT_CORNERS
 )
 from utils import compressed_fen
-from train import image_data
-from chessboard_finder import get_chessboard_corners
-from chessboard_image import get_chessboard_tiles
+from chessboard_finder import geometry_cache
+from chessboard_image import get_chessboard_tiles_array, crop_to_chessboard
 
 OUT_FILE = "debug.html"
 
-def _chessboard_tiles_img_data(chessboard_img_path, options={}):
-    """ Given a file path to a chessboard PNG image, returns a
-        size-64 array of 32x32 tiles representing each square of a chessboard
+# Tensorflow is imported when the model is loaded, since importing it takes
+# most of the startup time
+_model = None
+_serve = None
+
+# Options used when predict_chessboard is called from other code
+DEFAULT_OPTIONS = argparse.Namespace(quiet=False, debug=False)
+
+def _chessboard_tiles_img_data(chessboard_img, options=DEFAULT_OPTIONS):
+    """ Given a file path to a chessboard PNG image, or the image data as
+        bytes, a file-like object or a numpy array, returns a
+        (64, 32, 32, n_channels) uint8 array of tiles representing each
+        square of a chessboard
     """
-    n_channels = 1 if USE_GRAYSCALE else 3
-    tiles = get_chessboard_tiles(chessboard_img_path, use_grayscale=USE_GRAYSCALE)
-    img_data_list = []
-    for i in range(64):
-        buf = BytesIO()
-        tiles[i].save(buf, format='PNG')
-        img_data = tf.image.decode_image(buf.getvalue(), channels=n_channels)
-        img_data = tf.image.convert_image_dtype(img_data, tf.float32)
-        img_data = tf.image.resize(img_data, [32, 32])
-        img_data_list.append(img_data)
-    return img_data_list
+    if DETECT_CORNERS:
+        chessboard_img = _chessboard_img_crop(chessboard_img, options)
+    return get_chessboard_tiles_array(chessboard_img, use_grayscale=USE_GRAYSCALE)
+
+def _chessboard_img_crop(chessboard_img, options=DEFAULT_OPTIONS):
+    """ Crops a chessboard image to the detected corners of the chessboard.
+        Returns the whole image if no valid corners are found
+    """
+    img, error = crop_to_chessboard(chessboard_img)
+    if error is not None and not options.quiet:
+        print(error)
+    return img
+
+def _chessboard_img_name(chessboard_img):
+    """ File path of a chessboard image, or a placeholder for image data
+    """
+    if isinstance(chessboard_img, (str, os.PathLike)):
+        return str(chessboard_img)
+    return '<{} image>'.format(type(chessboard_img).__name__)
 
 def _confidence_color(confidence):
     if confidence >= 0.999:
@@ -49,11 +67,12 @@ def _confidence_color(confidence):
     else:
         return "#FF003C"
 
-def _save_output_html(chessboard_img_path, fen, predictions, confidence):
+def _save_output_html(chessboard_img, fen, predictions, confidence):
     confidence_color = _confidence_color(confidence)
-    html = '<h3>{}</h3>'.format(chessboard_img_path)
+    html = '<h3>{}</h3>'.format(_chessboard_img_name(chessboard_img))
     html += '<div class="boards-row">'
-    html += '<img src="{}" />'.format(chessboard_img_path)
+    if isinstance(chessboard_img, (str, os.PathLike)):
+        html += '<img src="{}" />'.format(chessboard_img)
     html += '<img src="http://www.fen-to-image.com/image/32/{}"/>'.format(fen)
     html += '<div class="predictions-matrix">'
     for i in range(8):
@@ -76,34 +95,38 @@ def _save_output_html(chessboard_img_path, fen, predictions, confidence):
     with open(OUT_FILE, "a") as f:
         f.write(html)
 
-def predict_chessboard(chessboard_img_path, options={}):
-    """ Given a file path to a chessboard PNG image,
+def predict_chessboard(chessboard_img, options=DEFAULT_OPTIONS):
+    """ Given a file path to a chessboard PNG image, or the image data as
+        bytes, a file-like object or a numpy array,
         Returns a FEN string representation of the chessboard
+
+        options = argparse.Namespace with quiet and debug flags. The
+                  prediction is appended to OUT_FILE if debug (or
+                  save_html, set by the command line) is set
+        Loads the model on first use if load_model() hasn't been called
     """
+    chessboard_img_name = _chessboard_img_name(chessboard_img)
     if not options.quiet:
-        print("Predicting chessboard {}".format(chessboard_img_path))
-    img_data_list = _chessboard_tiles_img_data(chessboard_img_path, options)
-    predictions = []
-    confidence = 1
-    for i in range(64):
-        # a8, b8 ... g1, h1
-        tile_img_data = img_data_list[i]
-        (fen_char, probability) = predict_tile(tile_img_data)
-        if not options.quiet:
-            print((fen_char, probability))
-        predictions.append((fen_char, probability))
+        print("Predicting chessboard {}".format(chessboard_img_name))
+    img_data_list = _chessboard_tiles_img_data(chessboard_img, options)
+    # a8, b8 ... g1, h1
+    predictions = predict_tiles(img_data_list)
+    if not options.quiet:
+        for prediction in predictions:
+            print(prediction)
     predicted_fen = compressed_fen(
         '/'.join(
             [''.join(r) for r in np.reshape([p[0] for p in predictions], [8, 8])]
         )
     )
+    confidence = reduce(lambda x,y: x*y, [p[1] for p in predictions])
     if not options.quiet:
-        confidence = reduce(lambda x,y: x*y, [p[1] for p in predictions])
         print("Confidence: {}".format(confidence))
-    # if options.debug:
-    print("https://lichess.org/editor/{}".format(predicted_fen))
-    _save_output_html(chessboard_img_path, predicted_fen, [p[1] for p in predictions], confidence)
-    print("Saved {} prediction to {}".format(chessboard_img_path, OUT_FILE))
+        print("https://lichess.org/editor/{}".format(predicted_fen))
+    if options.debug or getattr(options, 'save_html', False):
+        _save_output_html(chessboard_img, predicted_fen, [p[1] for p in predictions], confidence)
+        if not options.quiet:
+            print("Saved {} prediction to {}".format(chessboard_img_name, OUT_FILE))
     return predicted_fen
 
 def predict_tile(tile_img_data):
@@ -112,29 +135,122 @@ def predict_tile(tile_img_data):
 
         Returns a tuple of (predicted FEN char, confidence)
     """
-    probabilities = list(model.predict(np.array([tile_img_data]))[0])
-    max_probability = max(probabilities)
-    i = probabilities.index(max_probability)
-    return (FEN_CHARS[i], max_probability)
+    return predict_tiles(np.array([tile_img_data]))[0]
+
+def predict_tiles(tiles_img_data):
+    """ Given a batch of uint8 tile image data, predicts the tiles with the
+        model's pre-traced serving signature, NN_SERVING_BATCH_SIZE tiles
+        per call.
+
+        Returns a list of (predicted FEN char, confidence) tuples
+    """
+    if _serve is None:
+        load_model()
+    n_tiles = len(tiles_img_data)
+    probabilities = []
+    for i in range(0, n_tiles, NN_SERVING_BATCH_SIZE):
+        batch = tiles_img_data[i:i + NN_SERVING_BATCH_SIZE]
+        n = len(batch)
+        if n < NN_SERVING_BATCH_SIZE:
+            # The serving signature has a fixed batch size
+            batch = np.concatenate([
+                batch,
+                np.zeros((NN_SERVING_BATCH_SIZE - n,) + batch.shape[1:], dtype=np.uint8)
+            ])
+        probabilities.append(_serve(batch)[:n])
+    probabilities = np.concatenate(probabilities)
+    indexes = np.argmax(probabilities, axis=1)
+    return [
+        (FEN_CHARS[i], probabilities[n, i]) for (n, i) in enumerate(indexes)
+    ]
+
+def load_model(model_path=NN_MODEL_PATH):
+    """ Imports Tensorflow, loads the model's serving signature and warms it
+        up with one inference call. Models whose signature takes float32
+        tiles are given tiles converted to [0, 1]. Raises ValueError for
+        models with any other input.
+
+        Returns a dict of the time in seconds each step took, and the
+        Tensorflow version
+    """
+    global _model, _serve
+    timings = {}
+    t0 = time.perf_counter()
+    import tensorflow as tf
+    timings['import'] = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    # Keep a reference to the loaded model so its variables aren't freed
+    _model = tf.saved_model.load(model_path)
+    signature = _model.signatures['serving_default']
+    input_name, input_spec = next(iter(signature.structured_input_signature[1].items()))
+    n_channels = 1 if USE_GRAYSCALE else 3
+    tiles_shape = [NN_SERVING_BATCH_SIZE, 32, 32, n_channels]
+    if not input_spec.shape.is_compatible_with(tiles_shape):
+        raise ValueError(
+            'Model {} takes input of shape {}, but tiles have shape {}. '
+            'Check USE_GRAYSCALE or retrain with ./train.py'.format(
+                model_path, input_spec.shape, tiles_shape
+            )
+        )
+    if input_spec.dtype == tf.uint8:
+        to_input = tf.constant
+    elif input_spec.dtype == tf.float32:
+        # Models trained before tiles were kept as uint8, such as the v0.5
+        # pre-trained model, take tiles with values in [0, 1]
+        to_input = lambda tiles: tf.constant(tiles.astype(np.float32) / 255)
+    else:
+        raise ValueError(
+            'Model {} predates the uint8 serving signature (takes {} input), '
+            'retrain with ./train.py'.format(model_path, input_spec.dtype.name)
+        )
+    def serve(tiles):
+        outputs = signature(**{input_name: to_input(tiles)})
+        return next(iter(outputs.values())).numpy()
+    _serve = serve
+    timings['load'] = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    predict_tiles(np.zeros([NN_SERVING_BATCH_SIZE, 32, 32, n_channels], dtype=np.uint8))
+    timings['first_inference'] = time.perf_counter() - t0
+    timings['tensorflow_version'] = tf.version.VERSION
+    return timings
+
+def _print_startup_report(timings, time_to_first_fen):
+    print('Startup report:')
+    print('  import modules:    {:.3f}s'.format(timings['startup_imports']))
+    print('  import tensorflow: {:.3f}s'.format(timings['import']))
+    print('  load model:        {:.3f}s'.format(timings['load']))
+    print('  first inference:   {:.3f}s'.format(timings['first_inference']))
+    if time_to_first_fen is not None:
+        print('  time to first FEN: {:.3f}s'.format(time_to_first_fen))
 
 if __name__ == '__main__':
-    import argparse
+    startup_imports_time = time.perf_counter() - _start_time
     parser = argparse.ArgumentParser()
     parser.add_argument("-q", "--quiet", help="Only print recognized FEN position",
                         action="store_true")
     parser.add_argument("-d", "--debug", help="Saves debug output to debug.html",
                         action="store_true")
+    parser.add_argument("--startup-report", help="Print import, model load and first inference times",
+                        action="store_true")
     parser.add_argument("image_path", help="Path/glob to PNG chessboard image(s)")
     args = parser.parse_args()
+    # The command line always saves predictions to OUT_FILE
+    args.save_html = True
+    timings = load_model()
+    timings['startup_imports'] = startup_imports_time
     if not args.quiet:
-        print('Tensorflow {}'.format(tf.version.VERSION))
-    model = models.load_model(NN_MODEL_PATH)
-    # tile_img_path = glob(TILES_DIR + '/*/*.png')[0]
-    # print(tile_img_path)
-    # print(predict_tile(image_data(tile_img_path)))
+        print('Tensorflow {}'.format(timings['tensorflow_version']))
+    time_to_first_fen = None
     if len(sys.argv) > 1:
         with open(OUT_FILE, "w") as f:
             f.write('<link rel="stylesheet" href="./web/style.css" />')
         for chessboard_image_path in sorted(glob(args.image_path)):
             print(predict_chessboard(chessboard_image_path, args))
-
+            if time_to_first_fen is None:
+                time_to_first_fen = time.perf_counter() - _start_time
+    if args.startup_report:
+        _print_startup_report(timings, time_to_first_fen)
+    if DETECT_CORNERS and not args.quiet:
+        print(geometry_cache.report())
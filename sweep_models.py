@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+
+# Trains every model variant in train.MODEL_VARIANTS on the same dataset split
+# and compares accuracy, size, FLOPs and CPU latency. Saves a report of the
+# variants on the accuracy/latency Pareto front
+
+import os
+import json
+import time
+import argparse
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+
+import tensorflow as tf
+from tensorflow.keras import layers
+import numpy as np
+
+from train import MODEL_VARIANTS, N_EPOCHS, create_model, get_dataset
+
+REPORT_PATH = './nn/model_sweep.json'
+
+def _model_flops(model):
+    """ Estimates the number of floating point operations (multiply-adds
+        count as 2) for one tile, from the convolution and dense layers
+    """
+    flops = 0
+    for layer in model.layers:
+        if isinstance(layer, layers.SeparableConv2D):
+            _, out_h, out_w, out_c = layer.output_shape
+            in_c = layer.input_shape[-1]
+            k_h, k_w = layer.kernel_size
+            flops += 2 * out_h * out_w * in_c * k_h * k_w  # depthwise
+            flops += 2 * out_h * out_w * in_c * out_c      # pointwise
+        elif isinstance(layer, layers.Conv2D):
+            _, out_h, out_w, out_c = layer.output_shape
+            in_c = layer.input_shape[-1]
+            k_h, k_w = layer.kernel_size
+            flops += 2 * out_h * out_w * out_c * in_c * k_h * k_w
+        elif isinstance(layer, layers.Dense):
+            flops += 2 * layer.input_shape[-1] * layer.units
+    return flops
+
+def _latency_ms(model, input_batch, n_runs=20):
+    """ Median wall-clock time in milliseconds of running the model on a
+        batch of tiles, after one warm-up run
+    """
+    predict = tf.function(lambda x: model(x, training=False))
+    predict(input_batch)
+    timings = []
+    for _ in range(n_runs):
+        t0 = time.perf_counter()
+        predict(input_batch).numpy()
+        timings.append(time.perf_counter() - t0)
+    return float(np.median(timings) * 1000)
+
+def _pareto_front(results):
+    """ Names of variants that no other variant beats on both
+        accuracy and single-board latency
+    """
+    front = []
+    for r in results:
+        dominated = any(
+            o['accuracy'] >= r['accuracy'] and
+            o['board_latency_ms'] <= r['board_latency_ms'] and
+            (o['accuracy'] > r['accuracy'] or
+             o['board_latency_ms'] < r['board_latency_ms'])
+            for o in results
+        )
+        if not dominated:
+            front.append(r['variant'])
+    return front
+
+def sweep_models(variants, n_epochs, min_accuracy):
+    (train_images, train_labels, train_weights), \
+        (test_images, test_labels, test_weights) = get_dataset()
+    if not len(train_images):
+        print("No training images found!")
+        exit(1)
+    board_batch = test_images[np.arange(64) % len(test_images)]
+    boards_batch = test_images[np.arange(64 * 64) % len(test_images)]
+    results = []
+    for variant in variants:
+        print('Training model variant {}'.format(variant))
+        model = create_model(variant)
+        model.fit(train_images, train_labels, sample_weight=train_weights,
+                  epochs=n_epochs, verbose=2)
+        _, accuracy = model.evaluate(test_images, test_labels,
+                                     sample_weight=test_weights, verbose=0)
+        results.append({
+            'variant': variant,
+            'accuracy': float(accuracy),
+            'params': int(model.count_params()),
+            'flops_per_tile': int(_model_flops(model)),
+            'board_latency_ms': _latency_ms(model, board_batch),
+            'batch64_latency_ms': _latency_ms(model, boards_batch),
+        })
+        print(results[-1])
+    pareto_front = _pareto_front(results)
+    eligible = [r for r in results if r['accuracy'] >= min_accuracy]
+    fastest = min(eligible, key=lambda r: r['board_latency_ms']) if eligible else None
+    report = {
+        'n_epochs': n_epochs,
+        'min_accuracy': min_accuracy,
+        'results': results,
+        'pareto_front': pareto_front,
+        'fastest_eligible': fastest['variant'] if fastest else None,
+    }
+    report_dir = os.path.dirname(REPORT_PATH)
+    if not os.path.exists(report_dir):
+        os.makedirs(report_dir)
+    with open(REPORT_PATH, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    print('\n{:<12} {:>9} {:>9} {:>12} {:>11} {:>13}'.format(
+        'variant', 'accuracy', 'params', 'flops/tile', 'board (ms)', 'batch64 (ms)'
+    ))
+    for r in sorted(results, key=lambda r: r['board_latency_ms']):
+        print('{:<12} {:>9.4f} {:>9} {:>12} {:>11.2f} {:>13.2f} {}'.format(
+            r['variant'], r['accuracy'], r['params'], r['flops_per_tile'],
+            r['board_latency_ms'], r['batch64_latency_ms'],
+            '*' if r['variant'] in pareto_front else '',
+        ))
+    print('* = Pareto-optimal for accuracy vs. single-board latency')
+    if fastest:
+        print('Fastest variant with accuracy >= {}: {}'.format(
+            min_accuracy, fastest['variant']
+        ))
+    else:
+        print('No variant reached accuracy >= {}'.format(min_accuracy))
+    print('Saved model sweep report to {}'.format(REPORT_PATH))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-v", "--variant", help="Model variant(s) to compare",
+                        action="append", choices=sorted(MODEL_VARIANTS))
+    parser.add_argument("-e", "--epochs", help="Training epochs per variant",
+                        type=int, default=N_EPOCHS)
+    parser.add_argument("--min-accuracy", help="Accuracy bar for picking the fastest variant",
+                        type=float, default=0.999)
+    args = parser.parse_args()
+    print('Tensorflow {}'.format(tf.version.VERSION))
+    sweep_models(args.variant or list(MODEL_VARIANTS), args.epochs, args.min_accuracy)
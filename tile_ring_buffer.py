@@ -0,0 +1,152 @@
+import os
+import multiprocessing as mp
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from chessboard_finder import ChessboardGeometryCache
+from chessboard_image import get_chessboard_tiles_array, crop_to_chessboard
+
+class TileRingBuffer:
+    """ Fixed number of slots in shared memory, each holding the
+        (64, 32, 32, n_channels) uint8 tiles of one chessboard.
+
+        Decoder processes write tiles directly into a free slot and publish
+        it. The inference process reads published slots as numpy views of the
+        shared memory (no copying or pickling of tiles), and releases each
+        slot once it's done with it. Free slots are handed out in the order
+        they were released, starting with slot 0.
+
+        Only slot numbers and tags go through the queues. Pass the ring
+        buffer to worker processes as a Process or Pool initializer argument
+    """
+
+    def __init__(self, n_slots=16, n_channels=1, ctx=None):
+        ctx = ctx or mp.get_context()
+        self.shape = (n_slots, 64, 32, 32, n_channels)
+        self._shm = shared_memory.SharedMemory(create=True, size=int(np.prod(self.shape)))
+        self._free_slots = ctx.Queue()
+        self._ready_slots = ctx.Queue()
+        for slot in range(n_slots):
+            self._free_slots.put(slot)
+        self.blocks = np.ndarray(self.shape, dtype=np.uint8, buffer=self._shm.buf)
+
+    def __getstate__(self):
+        return {
+            'shape': self.shape,
+            'shm_name': self._shm.name,
+            'free_slots': self._free_slots,
+            'ready_slots': self._ready_slots,
+        }
+
+    def __setstate__(self, state):
+        self.shape = state['shape']
+        self._shm = shared_memory.SharedMemory(name=state['shm_name'])
+        self._free_slots = state['free_slots']
+        self._ready_slots = state['ready_slots']
+        self.blocks = np.ndarray(self.shape, dtype=np.uint8, buffer=self._shm.buf)
+
+    def acquire(self, timeout=None):
+        """ Producer: waits for a free slot and returns its number
+        """
+        return self._free_slots.get(timeout=timeout)
+
+    def publish(self, slot, tag=None):
+        """ Producer: hands a written slot to the consumer along with a
+            small picklable tag identifying the chessboard
+        """
+        self._ready_slots.put((slot, tag, True))
+
+    def publish_failed(self, slot, tag=None):
+        """ Producer: hands back a slot that couldn't be written. The
+            consumer still receives it, and releases it like any other slot
+        """
+        self._ready_slots.put((slot, tag, False))
+
+    def publish_done(self):
+        """ Producer: tells the consumer this producer process has no more
+            slots
+        """
+        self._ready_slots.put((None, os.getpid(), False))
+
+    def get(self, timeout=None):
+        """ Consumer: waits for a published slot. Returns (slot, tag, tiles)
+            where tiles is a view of the slot in shared memory, or None if
+            the producer failed to write the slot. Returns (None, pid, None)
+            when the producer process pid is done.
+
+            Raises queue.Empty if nothing was published within timeout seconds
+        """
+        slot, tag, ok = self._ready_slots.get(timeout=timeout)
+        if slot is None:
+            return (None, tag, None)
+        return (slot, tag, self.blocks[slot] if ok else None)
+
+    def release(self, slot):
+        """ Consumer: returns a slot to producers. Views of the slot must not
+            be used afterwards
+        """
+        self._free_slots.put(slot)
+
+    def close(self):
+        self.blocks = None
+        self._shm.close()
+
+    def unlink(self):
+        """ Frees the shared memory. Called once by the process that created
+            the ring buffer, after all processes are done with it
+        """
+        self.close()
+        self._shm.unlink()
+
+def decode_chessboards(ring, chessboard_imgs, use_grayscale=True, detect_corners=False):
+    """ Decoder process target. Writes the tiles of each chessboard image
+        into the ring buffer and publishes them tagged with their index
+
+        chessboard_imgs = list of (index, path or image data)
+        detect_corners = crop each image to its detected chessboard corners,
+                         with a geometry cache per decoder process
+    """
+    cache = ChessboardGeometryCache() if detect_corners else None
+    try:
+        for (i, chessboard_img) in chessboard_imgs:
+            slot = ring.acquire()
+            try:
+                if detect_corners:
+                    chessboard_img, error = crop_to_chessboard(chessboard_img, cache)
+                    if error is not None:
+                        print('Chessboard image {}: {}'.format(i, error))
+                get_chessboard_tiles_array(
+                    chessboard_img, use_grayscale=use_grayscale, out=ring.blocks[slot]
+                )
+            except Exception as e:
+                print('Failed to decode chessboard image {}: {}'.format(i, e))
+                ring.publish_failed(slot, i)
+                continue
+            ring.publish(slot, i)
+        if cache is not None:
+            print(cache.report())
+    finally:
+        ring.publish_done()
+        ring.close()
+
+def start_decoders(ring, chessboard_imgs, n_processes, use_grayscale=True,
+                   detect_corners=False):
+    """ Starts n_processes decoder processes, which split the chessboard
+        images between them. Returns the list of started processes
+
+        Start decoders before loading Tensorflow models, since forking a
+        process with Tensorflow loaded isn't safe
+    """
+    indexed_imgs = list(enumerate(chessboard_imgs))
+    processes = [
+        mp.Process(
+            target=decode_chessboards,
+            args=(ring, indexed_imgs[i::n_processes], use_grayscale, detect_corners),
+            daemon=True,
+        )
+        for i in range(n_processes)
+    ]
+    for process in processes:
+        process.start()
+    return processes
@@ -8,26 +8,42 @@ import tensorflow as tf
 from tensorflow.keras import layers, models
 import numpy as np
 
-from constants import TILES_DIR, NN_MODEL_PATH, FEN_CHARS, USE_GRAYSCALE
+from constants import (
+    TILES_DIR, NN_MODEL_PATH, FEN_CHARS, USE_GRAYSCALE, MANIFEST_PATH,
+    NN_SERVING_BATCH_SIZE,
+)
+from manifest import open_manifest, get_unique_tiles
+from chessboard_image import PHASH_VERSION
 
 RATIO = 0.82    # ratio of training vs. test data
 N_EPOCHS = 20
 
 def image_data(image_path) -> tf.image:
+    """ uint8 pixels of a tile image. Rescaling and resizing happen
+        inside the model
+    """
     n_channels = 1 if USE_GRAYSCALE else 3
     img = tf.io.read_file(image_path)
-    img = tf.image.decode_image(img, channels=n_channels)
-    img = tf.image.convert_image_dtype(img, tf.float32)
-    return tf.image.resize(img, [32, 32])
+    return tf.image.decode_image(img, channels=n_channels, expand_animations=False)
+
+def _input_layers(tile_size=32):
+    """ Takes uint8 tiles of any size and converts them to float32
+        tile_size x tile_size tiles with values in [0, 1]
+    """
+    n_channels = 1 if USE_GRAYSCALE else 3
+    return [
+        layers.Input(shape=(None, None, n_channels), dtype=tf.uint8),
+        layers.Rescaling(1. / 255),
+        layers.Resizing(tile_size, tile_size),
+    ]
 
-def create_model() -> models.Sequential:
+def _tutorial_cnn() -> models.Sequential:
     """ Convolutional neural network for image classification.
         Same architecture as:
         https://www.tensorflow.org/tutorials/images/cnn
     """
-    input_shape = (32, 32, 1) if USE_GRAYSCALE else (32, 32, 3)
-    model = models.Sequential([
-        layers.Conv2D(32, (3, 3), activation='relu', input_shape=input_shape),
+    return models.Sequential(_input_layers() + [
+        layers.Conv2D(32, (3, 3), activation='relu'),
         layers.MaxPooling2D((2, 2)),
         layers.Conv2D(64, (3, 3), activation='relu'),
         layers.MaxPooling2D((2, 2)),
@@ -36,61 +52,167 @@ def create_model() -> models.Sequential:
         layers.Dense(64, activation='relu'),
         layers.Dense(len(FEN_CHARS), activation='softmax'),
     ])
+
+def _small_cnn() -> models.Sequential:
+    """ Tutorial architecture with half the filters and an extra pooling
+        layer before the dense layers
+    """
+    return models.Sequential(_input_layers() + [
+        layers.Conv2D(16, (3, 3), activation='relu'),
+        layers.MaxPooling2D((2, 2)),
+        layers.Conv2D(32, (3, 3), activation='relu'),
+        layers.MaxPooling2D((2, 2)),
+        layers.Conv2D(32, (3, 3), activation='relu'),
+        layers.Flatten(),
+        layers.Dense(32, activation='relu'),
+        layers.Dense(len(FEN_CHARS), activation='softmax'),
+    ])
+
+def _separable_cnn() -> models.Sequential:
+    """ Tutorial architecture with depthwise-separable convolutions after
+        the first layer
+    """
+    return models.Sequential(_input_layers() + [
+        layers.Conv2D(32, (3, 3), activation='relu'),
+        layers.MaxPooling2D((2, 2)),
+        layers.SeparableConv2D(64, (3, 3), activation='relu'),
+        layers.MaxPooling2D((2, 2)),
+        layers.SeparableConv2D(64, (3, 3), activation='relu'),
+        layers.Flatten(),
+        layers.Dense(64, activation='relu'),
+        layers.Dense(len(FEN_CHARS), activation='softmax'),
+    ])
+
+def _tiny16_cnn() -> models.Sequential:
+    """ Small network that downsamples tiles to 16x16 first
+    """
+    return models.Sequential(_input_layers(16) + [
+        layers.Conv2D(16, (3, 3), activation='relu'),
+        layers.MaxPooling2D((2, 2)),
+        layers.Conv2D(32, (3, 3), activation='relu'),
+        layers.Flatten(),
+        layers.Dense(32, activation='relu'),
+        layers.Dense(len(FEN_CHARS), activation='softmax'),
+    ])
+
+# Neural network architectures that can be trained and compared with
+# ./sweep_models.py
+MODEL_VARIANTS = {
+    'tutorial': _tutorial_cnn,
+    'small': _small_cnn,
+    'separable': _separable_cnn,
+    'tiny16': _tiny16_cnn,
+}
+DEFAULT_MODEL_VARIANT = 'tutorial'
+
+def create_model(variant=DEFAULT_MODEL_VARIANT) -> models.Sequential:
+    """ Convolutional neural network for image classification.
+        variant = name of an architecture in MODEL_VARIANTS
+
+        Takes batches of uint8 tiles as input
+    """
+    model = MODEL_VARIANTS[variant]()
     model.compile(optimizer='adam',
                   loss='sparse_categorical_crossentropy',
                   metrics=['accuracy'])
     return model
 
+def serving_signature(model):
+    """ Pre-traced inference function with a fixed input shape of one
+        chessboard of uint8 tiles, exported with the saved model so that
+        ./recognize.py doesn't need to trace the model at startup
+    """
+    n_channels = 1 if USE_GRAYSCALE else 3
+    @tf.function(input_signature=[tf.TensorSpec(
+        [NN_SERVING_BATCH_SIZE, 32, 32, n_channels], tf.uint8, name='tiles'
+    )])
+    def serve(tiles):
+        return {'probabilities': model(tiles, training=False)}
+    return serve
+
+def _all_unique_tiles():
+    """ Paths of all unique PNG tiles recorded in the manifest, along with the
+        number of identical or near-identical tiles each one stands for.
+        Falls back to globbing TILES_DIR if no manifest has been generated yet
+    """
+    if not os.path.exists(MANIFEST_PATH):
+        tile_paths = sorted(glob('{}/*/*/*.png'.format(TILES_DIR)))
+        return (tile_paths, [1] * len(tile_paths))
+    conn = open_manifest()
+    unique_tiles = get_unique_tiles(conn, PHASH_VERSION)
+    conn.close()
+    return ([t[0] for t in unique_tiles], [t[2] for t in unique_tiles])
+
+def _load_images_and_labels(image_paths):
+    # TODO why does a list comprehension with np.array freeze??
+    images = []
+    labels = []
+    for image_path in image_paths:
+        piece_type = image_path[-5]
+        assert piece_type in FEN_CHARS
+        images.append(np.array(image_data(image_path)))
+        labels.append(FEN_CHARS.index(piece_type))
+    return (np.array(images, dtype=np.uint8), np.array(labels))
+
 def get_dataset():
-    """ Prepares training and test datasets from all PNG tiles
+    """ Prepares training and test datasets from all unique PNG tiles
         in TILES_DIR
+
+        Duplicate tiles are loaded once and weighted by how many times they
+        occur, so each duplicate group falls entirely on one side of the
+        train/test split. Returns (images, labels, weights) for each set
     """
-    all_paths = np.array(glob('{}/*/*/*.png'.format(TILES_DIR)))
+    tile_paths, tile_counts = _all_unique_tiles()
+    all_paths = np.array(tile_paths)
+    # Normalize so the average weight is 1
+    all_weights = np.array(tile_counts, dtype=np.float32)
+    all_weights *= len(all_weights) / max(all_weights.sum(), 1)
     np.random.seed(1)
-    np.random.shuffle(all_paths)
+    order = np.random.permutation(len(all_paths))
+    all_paths = all_paths[order]
+    all_weights = all_weights[order]
+    print("Found {} unique tiles out of {} total".format(
+        len(all_paths), sum(tile_counts)
+    ))
 
     divider = int(len(all_paths) * RATIO)
     train_paths = all_paths[:divider]
     test_paths = all_paths[divider:]
 
-    # TODO why does a list comprehension with np.array freeze??
-    train_images = []
-    train_labels = []
-    for image_path in train_paths:
-        piece_type = image_path[-5]
-        assert piece_type in FEN_CHARS
-        train_images.append(np.array(image_data(image_path)))
-        train_labels.append(FEN_CHARS.index(piece_type))
-    train_images = np.array(train_images)
-    train_labels = np.array(train_labels)
+    train_images, train_labels = _load_images_and_labels(train_paths)
+    train_weights = all_weights[:divider]
     print("Loaded {} training images and labels".format(len(train_paths)))
 
-    test_images = []
-    test_labels = []
-    for image_path in test_paths:
-        piece_type = image_path[-5]
-        assert piece_type in FEN_CHARS
-        test_images.append(np.array(image_data(image_path)))
-        test_labels.append(FEN_CHARS.index(piece_type))
-    test_images = np.array(test_images)
-    test_labels = np.array(test_labels)
+    test_images, test_labels = _load_images_and_labels(test_paths)
+    test_weights = all_weights[divider:]
     print("Loaded {} test images and labels".format(len(test_paths)))
-    return ((train_images, train_labels), (test_images, test_labels))
-
+    return (
+        (train_images, train_labels, train_weights),
+        (test_images, test_labels, test_weights),
+    )
 
 if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--variant", help="Neural network architecture to train",
+                        choices=sorted(MODEL_VARIANTS), default=DEFAULT_MODEL_VARIANT)
+    args = parser.parse_args()
     print('Tensorflow {}'.format(tf.version.VERSION))
 
-    (train_images, train_labels), (test_images, test_labels) = get_dataset()
+    (train_images, train_labels, train_weights), \
+        (test_images, test_labels, test_weights) = get_dataset()
     if not len(train_images):
         print("No training images found!")
         exit(1)
-    model = create_model()
-    model.fit(train_images, train_labels, epochs=N_EPOCHS,
-              validation_data=(test_images, test_labels))
+    model = create_model(args.variant)
+    model.fit(train_images, train_labels, sample_weight=train_weights,
+              epochs=N_EPOCHS,
+              validation_data=(test_images, test_labels, test_weights))
 
     print('Saving CNN model to {}'.format(NN_MODEL_PATH))
-    models.save_model(model, NN_MODEL_PATH, overwrite=True)
+    models.save_model(model, NN_MODEL_PATH, overwrite=True,
+                      signatures={'serving_default': serving_signature(model)})
 
     print('Evaluating CNN model on test data:')
-    test_loss, test_acc = model.evaluate(test_images,  test_labels, verbose=1)
+    test_loss, test_acc = model.evaluate(test_images,  test_labels,
+                                         sample_weight=test_weights, verbose=1)
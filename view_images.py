@@ -3,43 +3,148 @@
 import sys
 import os
 from glob import glob
+from multiprocessing import Pool
+
+import PIL.Image
 
 from constants import CHESSBOARDS_DIR, TILES_DIR
 
 OUT_FILE = 'images.html'
+OUT_DIR = 'images_report'
+BOARDS_PER_PAGE = 50
+
+def _group_tiles_by_board(tile_img_paths):
+    """ Groups tile image paths by their board's tile directory, reading the
+        square and piece from each filename. For example:
+
+        ./images/tiles/generated/<board>/d8_q.png => ('d8', 'q')
+
+        Returns { tile_dir: { square_id: (tile_img_path, fen_char) } }
+    """
+    boards = {}
+    for tile_img_path in tile_img_paths:
+        tile_dir, filename = os.path.split(tile_img_path)
+        boards.setdefault(tile_dir, {})[filename[:2]] = (tile_img_path, filename[3])
+    return boards
+
+def _sprite_path(tile_dir):
+    img_dir = tile_dir.split('/')[-2]
+    img_filename_prefix = tile_dir.split('/')[-1]
+    return os.path.join(OUT_DIR, 'sprites', img_dir, '{}.png'.format(img_filename_prefix))
+
+def _square_ids():
+    """ a8, b8 ... g1, h1
+    """
+    return [
+        '{}{}'.format(file, rank)
+        for rank in [8,7,6,5,4,3,2,1]
+        for file in ['a','b','c','d','e','f','g','h']
+    ]
+
+def _save_sprite(board):
+    """ Composes the 64 tiles of a board into a single 256x256 image.
+        Skips boards whose sprite is newer than all of their tile files
+    """
+    tile_dir, square_map = board
+    sprite_path = _sprite_path(tile_dir)
+    if os.path.exists(sprite_path):
+        # Re-tiling a board overwrites its tile files, which doesn't change
+        # the mtime of the tile directory
+        newest_tile_mtime = max(
+            os.path.getmtime(tile_img_path) for (tile_img_path, _) in square_map.values()
+        )
+        if os.path.getmtime(sprite_path) >= newest_tile_mtime:
+            return sprite_path
+    sprite = PIL.Image.new('RGB', (256, 256))
+    for i, square_id in enumerate(_square_ids()):
+        if square_id in square_map:
+            tile_img_path = square_map[square_id][0]
+            sprite.paste(PIL.Image.open(tile_img_path), ((i % 8) * 32, (i // 8) * 32))
+    os.makedirs(os.path.dirname(sprite_path), exist_ok=True)
+    sprite.save(sprite_path, format='PNG')
+    return sprite_path
+
+def _remove_stale_sprites(sub_dir, boards):
+    """ Removes sprites in sub_dir of boards whose tiles no longer exist
+    """
+    sprite_paths = set(_sprite_path(tile_dir) for tile_dir in boards)
+    for sprite_path in glob(os.path.join(OUT_DIR, 'sprites', sub_dir, '*.png')):
+        if sprite_path not in sprite_paths:
+            os.remove(sprite_path)
 
-def _save_output_html(tile_dirs):
+def _page_filename(page_i):
+    return 'page-{:04d}.html'.format(page_i + 1)
+
+def _board_html(tile_dir, square_map):
+    img_dir = tile_dir.split('/')[-2]
+    img_filename_prefix = tile_dir.split('/')[-1]
+    chessboard_img_path = os.path.join(
+        CHESSBOARDS_DIR, img_dir, '{}.png'.format(img_filename_prefix)
+    )
+    html = '<h3>{}</h3>'.format(chessboard_img_path)
+    html += '<div class="boards-row">'
+    html += '<img src="{}" loading="lazy" />'.format(
+        os.path.relpath(chessboard_img_path, OUT_DIR)
+    )
+    html += '<img src="{}" loading="lazy" />'.format(
+        os.path.relpath(_sprite_path(tile_dir), OUT_DIR)
+    )
+    html += '<div class="tile-labels">'
+    for i, square_id in enumerate(_square_ids()):
+        fen_char = square_map[square_id][1] if square_id in square_map else '?'
+        html += '<span class="fen-char {}">{}</span>'.format(
+            'empty' if fen_char == '1' else '',
+            fen_char
+        )
+        if i % 8 == 7:
+            html += '<br />'
+    html += '</div>'
+    html += '</div>'
+    html += '<div>{}</div>'.format(tile_dir)
+    return html
+
+def _save_page_html(page_i, n_pages, boards):
+    html = '<html lang="en">'
+    html += '<link rel="stylesheet" href="../web/style.css" />'
+    nav = '<div class="page-nav">'
+    if page_i > 0:
+        nav += '<a href="{}">&larr; prev</a> '.format(_page_filename(page_i - 1))
+    nav += '<a href="../{}">index</a> '.format(OUT_FILE)
+    nav += 'page {} of {} '.format(page_i + 1, n_pages)
+    if page_i < n_pages - 1:
+        nav += '<a href="{}">next &rarr;</a>'.format(_page_filename(page_i + 1))
+    nav += '</div>'
+    html += nav
+    for (tile_dir, square_map) in boards:
+        html += _board_html(tile_dir, square_map)
+    html += nav
+    html += '</html>'
+    with open(os.path.join(OUT_DIR, _page_filename(page_i)), 'w') as f:
+        f.write(html)
+
+def _save_output_html(boards):
+    """ Saves fixed-size pages of BOARDS_PER_PAGE boards each to OUT_DIR,
+        and an index of all pages to OUT_FILE
+    """
+    boards = sorted(boards.items())
+    n_pages = (len(boards) + BOARDS_PER_PAGE - 1) // BOARDS_PER_PAGE
+    # Pages left over from a run with more boards
+    page_filenames = set(_page_filename(page_i) for page_i in range(n_pages))
+    for page_path in glob(os.path.join(OUT_DIR, 'page-*.html')):
+        if os.path.basename(page_path) not in page_filenames:
+            os.remove(page_path)
     html = '<html lang="en">'
     html += '<link rel="stylesheet" href="./web/style.css" />'
-    for tile_dir in tile_dirs:
-        img_dir = tile_dir.split('/')[-2]
-        img_filename_prefix = tile_dir.split('/')[-1]
-        chessboard_img_path = os.path.join(
-            CHESSBOARDS_DIR, img_dir, '{}.png'.format(img_filename_prefix)
+    html += '<h3>{} chessboards</h3>'.format(len(boards))
+    for page_i in range(n_pages):
+        page_boards = boards[page_i * BOARDS_PER_PAGE:(page_i + 1) * BOARDS_PER_PAGE]
+        _save_page_html(page_i, n_pages, page_boards)
+        html += '<div><a href="{}">{}</a> {} &ndash; {}</div>'.format(
+            os.path.join(OUT_DIR, _page_filename(page_i)),
+            _page_filename(page_i),
+            page_boards[0][0],
+            page_boards[-1][0],
         )
-        html += '<h3>{}</h3>'.format(chessboard_img_path)
-        html += '<img src="{}" class="chessboard"/>'.format(chessboard_img_path)
-        html += '<h3>{}</h3>'.format(tile_dir)
-        square_map = {}
-        for tile_img_path in glob(os.path.join(tile_dir, '*.png')):
-            square_id = tile_img_path[-8:-6]
-            fen_char = tile_img_path[-5]
-            square_map[square_id] = {
-                'img_src': tile_img_path,
-                'fen_char': fen_char,
-            }
-        for rank in [8,7,6,5,4,3,2,1]:
-            for file in ['a','b','c','d','e','f','g','h']:
-                square_id = '{}{}'.format(file, rank)
-                square = square_map[square_id]
-                fen_char = square['fen_char']
-                html += '<img src="{}"/>'.format(square['img_src'])
-                html += '<span class="fen-char {}">{}</span>'.format(
-                    'empty' if fen_char is '1' else '',
-                    fen_char
-                )
-            html += '<br />'
-        html += '<br />'
     html += '</html>'
     with open(OUT_FILE, 'w') as f:
         f.write(html)
@@ -48,8 +153,14 @@ if __name__ == '__main__':
     sub_dir = sys.argv[1] if len(sys.argv) > 1 else '*'
     tiles_base_dir = os.path.join(TILES_DIR, sub_dir, '*')
     print('Looking for tile images in {}'.format(tiles_base_dir))
-    print('Found {} tile images'.format(
-        len(glob(os.path.join(tiles_base_dir, '*.png')))
+    boards = _group_tiles_by_board(glob(os.path.join(tiles_base_dir, '*.png')))
+    print('Found {} tile images from {} chessboards'.format(
+        sum(len(square_map) for square_map in boards.values()), len(boards)
     ))
-    _save_output_html(glob(tiles_base_dir))
+    os.makedirs(OUT_DIR, exist_ok=True)
+    with Pool() as pool:
+        for _ in pool.imap_unordered(_save_sprite, boards.items(), chunksize=16):
+            pass
+    _remove_stale_sprites(sub_dir, boards)
+    _save_output_html(boards)
     print('Open {} to view all tile images'.format(OUT_FILE))